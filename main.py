@@ -1,7 +1,11 @@
 import asyncio
 import base64
+import hashlib
+import os
 import re
 import time
+from collections import OrderedDict
+from typing import Final
 
 import aiohttp
 from astrbot.api.event import filter, AstrMessageEvent
@@ -9,8 +13,100 @@ from astrbot.api.star import Context, Star, register, StarTools
 from astrbot.api import logger
 from astrbot.api.all import Image, Plain
 from astrbot.core.message.components import Reply
-from .utils.ttp import generate_image_vertex
-from .utils.file_send_server import send_file
+from .utils.ttp import generate_image_vertex, close_session as close_vertex_session
+from .utils.file_send_server import send_file, close_session as close_upload_session
+
+# 提示词清理用的正则（预编译）
+_SPACES_PATTERN = re.compile(r"[ \t]+")
+_BLANK_LINES_PATTERN = re.compile(r"\n\s*\n")
+
+# 视为“真”的指令参数取值
+_TRUTHY_VALUES = frozenset({"true", "1", "yes", "y", "on"})
+
+# 手办化系列指令使用的固定提示词
+_FIGURE_PROMPT_V1: Final[str] = """Please accurately transform the main subject in this image into a realistic, masterpiece-quality 1/7 scale PVC figure.
+
+Specific Requirements:
+1. **Figure Creation**: Convert the subject into a high-quality PVC figure with obvious three-dimensional depth and the characteristic glossy finish of PVC material
+2. **Packaging Box Design**: Place an exquisite packaging box beside the figure. The front of the box should have a large transparent window displaying the original image, along with brand logos, product name, barcode, and detailed specification panels
+3. **Display Base**: The figure should be placed on a round, transparent plastic base with visible thickness
+4. **Background Setup**: Place a computer monitor in the background, with the screen displaying the ZBrush 3D modeling process of this figure
+5. **Indoor Scene**: Set the entire scene in an indoor environment with appropriate lighting effects
+
+Technical Requirements:
+- Maintain the exact characteristics, expressions, and poses from the original image
+- The figure must have obvious three-dimensional effects and must never appear flat
+- PVC material texture should be clearly visible and realistic
+- Avoid any cartoon outline strokes
+- If the original image is not full-body, complete it as a full-body figure
+- Character proportions should be natural and coordinated (head not too large, legs not too short)
+- For animal figures, reduce fur realism to make it more statue-like rather than the real creature
+- Pay attention to perspective relationships with near objects appearing larger and distant objects smaller
+- No outer outline lines should be present
+
+Please ensure the final result looks like a real commercial figure product that could exist in the market."""
+
+_FIGURE_PROMPT_V2: Final[str] = (
+    "将画面中的角色重塑为顶级收藏级树脂手办，全身动态姿势，置于角色主题底座，高精度材质，手工涂装，"
+    "肌肤纹理与服装材质真实分明。戏剧性硬光为主光源，凸显立体感，无过曝；强效补光消除死黑，细节完整可见。"
+    "背景为窗边景深模糊，侧后方隐约可见产品包装盒。博物馆级摄影质感，全身细节无损，面部结构精准。"
+    "禁止：任何2D元素或照搬原图、塑料感、面部模糊、五官错位、细节丢失。"
+)
+
+_FIGURE_PROMPT_V3: Final[str] = (
+    "Create a highly realistic 1/7 scale commercialized figure based on the illustration's adult character, "
+    "ensuring the appearance and content are safe, healthy, and free from any inappropriate elements. "
+    "Render the figure in a detailed, lifelike style and environment, placed on a shelf inside an ultra-realistic "
+    "figure display cabinet, mounted on a circular transparent acrylic base without any text. Maintain highly precise "
+    "details in texture, material, and paintwork to enhance realism. The cabinet scene should feature a natural depth "
+    "of field with a smooth transition between foreground and background for a realistic photographic look. Lighting "
+    "should appear natural and adaptive to the scene, automatically adjusting based on the overall composition instead "
+    "of being locked to a specific direction, simulating the quality and reflection of real commercial photography. "
+    "Other shelves in the cabinet should contain different figures which are slightly blurred due to being out of focus, "
+    "enhancing spatial realism and depth."
+)
+
+# 逗号分隔配置项的拆分正则（同时去除两侧空白）
+_COMMA_SPLIT_PATTERN = re.compile(r"\s*,\s*")
+
+# 指令名 -> 去除指令前缀的正则
+_COMMAND_PATTERNS: dict[str, re.Pattern] = {}
+
+
+def _get_command_pattern(command: str) -> re.Pattern:
+    """获取（必要时编译）匹配指令及其后空白的正则"""
+    pattern = _COMMAND_PATTERNS.get(command)
+    if pattern is None:
+        pattern = re.compile(rf"/?{re.escape(command)}[\s]*")
+        _COMMAND_PATTERNS[command] = pattern
+    return pattern
+
+
+def _normalize_str_list(value) -> list[str]:
+    """
+    将配置中的列表项（API 密钥、群号等）规范化为字符串列表。
+
+    支持以下输入形式：
+    - 单个字符串（可用逗号分隔多个值，兼容旧配置）
+    - 列表（元素会被转为字符串并去除空白）
+    """
+    if value is None:
+        return []
+
+    if isinstance(value, str):
+        return [part for part in _COMMA_SPLIT_PATTERN.split(value.strip()) if part]
+
+    if isinstance(value, list):
+        items: list[str] = []
+        for item in value:
+            if item is None:
+                continue
+            text = str(item).strip()
+            if text:
+                items.append(text)
+        return items
+
+    return []
 
 
 @register("astrbot_plugin_vertex_image-command", "YanL", "使用 Google Vertex AI 生成图片", "1.0.0")
@@ -19,7 +115,7 @@ class MyPlugin(Star):
         super().__init__(context)
 
         # Vertex AI 配置
-        self.vertex_api_keys = self._normalize_api_keys(config.get("vertex_api_key"))
+        self.vertex_api_keys = _normalize_str_list(config.get("vertex_api_key"))
 
         # 模型配置
         self.model_name = config.get("model_name", "gemini-3-pro-image-preview").strip()
@@ -30,18 +126,39 @@ class MyPlugin(Star):
         # NAP 文件服务器配置
         self.nap_server_address = config.get("nap_server_address")
         self.nap_server_port = config.get("nap_server_port")
+        # 配置了非本机地址时才需要转发文件
+        self._nap_enabled = bool(self.nap_server_address) and self.nap_server_address != "localhost"
 
         # 群过滤配置（模式 + 名单）
         self.group_filter_mode = str(config.get("group_filter_mode", "none") or "none").strip().lower()
-        self.group_filter_list = self._normalize_id_list(config.get("group_filter_list"))
+        self._group_filter_set = frozenset(_normalize_str_list(config.get("group_filter_list")))
 
         # 限流配置（按群）
         self.rate_limit_max_calls_per_group = int(config.get("rate_limit_max_calls_per_group", 0) or 0)
         self.rate_limit_period_seconds = int(config.get("rate_limit_period_seconds", 60) or 60)
 
-        # 限流状态：group_id -> (window_start_ts, count)
-        self._rate_limit_state: dict[str, tuple[float, int]] = {}
-        self._rate_limit_lock = asyncio.Lock()
+        # 生成结果缓存配置，0 表示不缓存
+        self.result_cache_size = int(config.get("result_cache_size", 128) or 0)
+
+        # 生成结果缓存：cache_key -> (image_url, image_path)，按最近使用排序
+        self._result_cache: OrderedDict[bytes, tuple[str, str]] = OrderedDict()
+
+        # 正在进行的生成请求：cache_key -> Task，用于合并重复请求
+        self._inflight: dict[bytes, asyncio.Task] = {}
+
+        # 限流状态（令牌桶）：group_id -> [tokens, last_refill_ts]
+        self._rate_limit_buckets: dict[str, list[float]] = {}
+
+        # 运行期不变的配置，启动时读取一次
+        self._callback_api_base = None
+        self._data_dir = None
+        self.reload_cached_config()
+
+    def reload_cached_config(self):
+        """重新读取缓存的全局配置（callback_api_base 与数据目录）。"""
+        self._callback_api_base = self.context.get_config().get("callback_api_base")
+        # 使用 StarTools 获取标准数据目录，避免污染源码目录
+        self._data_dir = StarTools.get_data_dir("vertex_image-command")
 
     async def send_image_with_callback_api(self, image_path: str) -> Image:
         """
@@ -53,7 +170,7 @@ class MyPlugin(Star):
         Returns:
             Image: 图片组件
         """
-        callback_api_base = self.context.get_config().get("callback_api_base")
+        callback_api_base = self._callback_api_base
         if not callback_api_base:
             logger.info("未配置callback_api_base，使用本地文件发送")
             return Image.fromFileSystem(image_path)
@@ -90,86 +207,83 @@ class MyPlugin(Star):
             logger.error("未配置 vertex_api_key，无法生成图像")
             return None, None, "NO_API_KEY"
 
-        logger.info(
-            f"使用 Vertex AI 生成图像，model={self.model_name}"
-        )
+        cache_key = self._make_cache_key(self.model_name, prompt, input_images)
+        if not self._use_result_cache(input_images):
+            # 纯文本生图或关闭缓存时每次都独立生成，不与并发的相同请求合并
+            return await self._generate_and_cache(cache_key, prompt, input_images)
+
+        cached = self._result_cache.get(cache_key)
+        if cached is not None:
+            # 生成的图片会被定期清理，命中时需确认文件仍然存在
+            if os.path.exists(cached[1]):
+                self._result_cache.move_to_end(cache_key)
+                logger.info("命中生成结果缓存，跳过 Vertex AI 调用")
+                return cached[0], cached[1], None
+            del self._result_cache[cache_key]
+
+        # 相同请求正在生成时直接等待其结果，避免重复调用 API
+        task = self._inflight.get(cache_key)
+        if task is not None:
+            logger.info("相同的图像生成请求正在进行中，等待其结果")
+        else:
+            # 生成在独立任务中运行，任一调用方被取消都不会影响其他等待者
+            task = asyncio.ensure_future(
+                self._generate_and_cache(cache_key, prompt, input_images)
+            )
+            # 读取异常，避免所有调用方都被取消时产生未读取异常的告警
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[cache_key] = task
 
-        # 使用 StarTools 获取标准数据目录，避免污染源码目录
-        data_dir = StarTools.get_data_dir("vertex_image-command")
+        return await asyncio.shield(task)
 
-        return await generate_image_vertex(
-            prompt,
-            api_key=self.vertex_api_keys,
-            model=self.model_name,
-            input_images=input_images,
-            max_retry_attempts=self.max_retry_attempts,
-            data_dir=data_dir,
+    async def _generate_and_cache(self, cache_key: bytes, prompt: str, input_images: list | None):
+        """实际调用 Vertex AI 生成图像，并在成功时写入结果缓存。"""
+        logger.info(
+            f"使用 Vertex AI 生成图像，model={self.model_name}"
         )
 
-    @staticmethod
-    def _normalize_api_keys(value) -> list[str]:
-        """
-        将配置中的 vertex_api_key 规范化为字符串列表。
+        try:
+            image_url, image_path, error_reason = await generate_image_vertex(
+                prompt,
+                api_key=self.vertex_api_keys,
+                model=self.model_name,
+                input_images=input_images,
+                max_retry_attempts=self.max_retry_attempts,
+                data_dir=self._data_dir,
+            )
+        finally:
+            self._inflight.pop(cache_key, None)
 
-        支持以下输入形式：
-        - 单个字符串（可能包含逗号分隔的多个 key）
-        - 字符串列表
-        - 其他可转为字符串的元素列表
-        """
-        if value is None:
-            return []
-
-        keys: list[str] = []
-
-        # 字符串形式：支持用逗号分隔多个 key，兼容旧配置
-        if isinstance(value, str):
-            for part in value.split(","):
-                k = part.strip()
-                if k:
-                    keys.append(k)
-            return keys
-
-        # 列表形式：逐项转为字符串并去空白
-        if isinstance(value, list):
-            for item in value:
-                if item is None:
-                    continue
-                k = str(item).strip()
-                if k:
-                    keys.append(k)
+        if self._use_result_cache(input_images) and image_url and image_path:
+            self._result_cache[cache_key] = (image_url, image_path)
+            self._result_cache.move_to_end(cache_key)
+            while len(self._result_cache) > self.result_cache_size:
+                self._result_cache.popitem(last=False)
 
-        return keys
+        return image_url, image_path, error_reason
 
-    @staticmethod
-    def _normalize_id_list(value) -> list[str]:
+    def _use_result_cache(self, input_images: list | None) -> bool:
         """
-        将配置中的群号列表规范化为字符串列表。
+        是否对本次请求使用结果缓存。
 
-        支持：
-        - 单个字符串（可用逗号分隔多个群号）
-        - 列表（元素会被转为字符串）
+        仅缓存带参考图片的请求（手办化、改图等）；纯文本生图每次都重新生成，
+        以便用户用相同提示词重新抽取不同结果。
         """
-        if value is None:
-            return []
-
-        ids: list[str] = []
+        return self.result_cache_size > 0 and bool(input_images)
 
-        if isinstance(value, str):
-            for part in value.split(","):
-                gid = part.strip()
-                if gid:
-                    ids.append(gid)
-            return ids
-
-        if isinstance(value, list):
-            for item in value:
-                if item is None:
-                    continue
-                gid = str(item).strip()
-                if gid:
-                    ids.append(gid)
-
-        return ids
+    @staticmethod
+    def _make_cache_key(model: str, prompt: str, input_images: list | None) -> bytes:
+        """根据模型、提示词和输入图片计算生成结果的缓存键。"""
+        # 逐段增量哈希，避免拼接大体积的 base64 字符串；各段以 \0 分隔
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(model.encode("utf-8"))
+        hasher.update(b"\0")
+        hasher.update(prompt.encode("utf-8"))
+        for img in input_images or []:
+            if img:
+                hasher.update(b"\0")
+                hasher.update(img.encode("utf-8") if isinstance(img, str) else img)
+        return hasher.digest()
 
     def _is_group_allowed(self, event: AstrMessageEvent) -> bool:
         """
@@ -180,6 +294,14 @@ class MyPlugin(Star):
         - mode = blacklist: 名单内群禁止；
         - mode = none 或其他: 不做群过滤。
         """
+        mode = self.group_filter_mode or "none"
+
+        # none 或未知值：不做过滤，也无需获取群号
+        if mode not in {"whitelist", "blacklist"}:
+            if mode != "none":
+                logger.warning(f"未知的 group_filter_mode={mode}，按 none 处理")
+            return True
+
         group_id = None
         try:
             group_id = event.get_group_id()
@@ -191,29 +313,25 @@ class MyPlugin(Star):
             return True
 
         gid = str(group_id)
-        mode = self.group_filter_mode or "none"
 
         if mode == "whitelist":
-            allowed = gid in self.group_filter_list
+            allowed = gid in self._group_filter_set
             if not allowed:
                 logger.info(f"群 {gid} 不在白名单中，忽略指令")
             return allowed
 
-        if mode == "blacklist":
-            if gid in self.group_filter_list:
-                logger.info(f"群 {gid} 命中黑名单，忽略指令")
-                return False
-            return True
-
-        # none 或未知值：不做过滤
-        if mode not in {"none", "whitelist", "blacklist"}:
-            logger.warning(f"未知的 group_filter_mode={mode}，按 none 处理")
+        if gid in self._group_filter_set:
+            logger.info(f"群 {gid} 命中黑名单，忽略指令")
+            return False
         return True
 
     async def _check_and_consume_rate_limit(self, event: AstrMessageEvent) -> bool:
         """
         检查并消耗当前群的限流配额。
 
+        按群使用令牌桶：桶容量为单群调用上限，每个周期匀速补满。
+        读取与写回之间没有 await，在单个事件循环内天然原子，无需加锁。
+
         返回 True 表示允许本次调用；False 表示已达到上限。
         """
         if self.rate_limit_max_calls_per_group <= 0 or self.rate_limit_period_seconds <= 0:
@@ -230,23 +348,29 @@ class MyPlugin(Star):
             return True
 
         gid = str(group_id)
-        now = time.time()
-
-        async with self._rate_limit_lock:
-            window_start, count = self._rate_limit_state.get(gid, (now, 0))
-
-            # 如果已经超过周期，重置窗口
-            if now - window_start >= self.rate_limit_period_seconds:
-                window_start = now
-                count = 0
-
-            if count >= self.rate_limit_max_calls_per_group:
-                logger.info(f"群 {gid} 已达到限流上限 ({count}/{self.rate_limit_max_calls_per_group})")
-                return False
-
-            # 消耗一次配额
-            self._rate_limit_state[gid] = (window_start, count + 1)
-            return True
+        # 使用单调时钟，避免系统时间调整导致配额异常
+        now = time.monotonic()
+        capacity = float(self.rate_limit_max_calls_per_group)
+        refill_rate = capacity / self.rate_limit_period_seconds
+
+        bucket = self._rate_limit_buckets.get(gid)
+        if bucket is None:
+            # 上次补充时间为 -inf，首次计算时自然补满
+            bucket = [0.0, float("-inf")]
+            self._rate_limit_buckets[gid] = bucket
+
+        # 按距上次补充的时间补充令牌
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * refill_rate)
+        bucket[1] = now
+
+        if tokens < 1:
+            bucket[0] = tokens
+            logger.info(f"群 {gid} 已达到限流上限 ({self.rate_limit_max_calls_per_group}/{self.rate_limit_period_seconds}s)")
+            return False
+
+        # 消耗一次配额
+        bucket[0] = tokens - 1
+        return True
 
     @staticmethod
     def _get_error_message(error_reason: str | None, command_name: str = "图像生成") -> str:
@@ -267,26 +391,38 @@ class MyPlugin(Star):
         # API_ERROR 或其他未知错误
         return f"{command_name}失败，请检查 Vertex AI API 配置和网络连接。"
 
+    @staticmethod
+    async def _image_to_base64(comp: Image, source: str) -> str | None:
+        """
+        将单个图片组件转换为 base64，失败时记录日志并返回 None。
+
+        Args:
+            comp: 图片组件
+            source: 图片来源描述，用于日志
+        """
+        try:
+            return await comp.convert_to_base64()
+        except (IOError, ValueError, OSError) as e:
+            logger.warning(f"转换{source}到base64失败: {e}")
+        except Exception as e:
+            logger.error(f"处理{source}时出现未预期的错误: {e}")
+        return None
+
     async def _collect_input_images(self, event: AstrMessageEvent) -> list[str]:
         """
         从当前事件中收集图片（包含直接发送的图片和引用消息中的图片）。
         返回 base64 字符串列表。
         """
-        images: list[str] = []
         reply_id: str | None = None
-        reply_images_found = False
+        # (图片组件, 来源, 所属 Reply 的位置)，按消息顺序排列；
+        # 来源为 "message"、"reply"（Reply.chain）或 "fallback"（Reply.message）
+        pending: list[tuple[Image, str, int]] = []
 
-        if hasattr(event, "message_obj") and event.message_obj and hasattr(event.message_obj, "message"):
-            for comp in event.message_obj.message:
+        message = getattr(getattr(event, "message_obj", None), "message", None)
+        if message:
+            for index, comp in enumerate(message):
                 if isinstance(comp, Image):
-                    try:
-                        base64_data = await comp.convert_to_base64()
-                        images.append(base64_data)
-                        logger.info("从消息中获取到图片")
-                    except (IOError, ValueError, OSError) as e:
-                        logger.warning(f"转换图片到base64失败: {e}")
-                    except Exception as e:
-                        logger.error(f"处理图片时出现未预期的错误: {e}")
+                    pending.append((comp, "message", index))
                 elif isinstance(comp, Reply):
                     # 尝试多种方式获取 reply_id
                     if hasattr(comp, 'id') and comp.id:
@@ -300,27 +436,43 @@ class MyPlugin(Star):
                     if hasattr(comp, 'chain') and comp.chain:
                         for reply_comp in comp.chain:
                             if isinstance(reply_comp, Image):
-                                try:
-                                    base64_data = await reply_comp.convert_to_base64()
-                                    images.append(base64_data)
-                                    logger.info("从引用消息中获取到图片")
-                                    reply_images_found = True
-                                except (IOError, ValueError, OSError) as e:
-                                    logger.warning(f"转换引用消息中的图片到base64失败: {e}")
-                                except Exception as e:
-                                    logger.error(f"处理引用消息中的图片时出现未预期的错误: {e}")
+                                pending.append((reply_comp, "reply", index))
                     
-                    # 方式2：从 comp.message 获取
-                    if not reply_images_found and hasattr(comp, 'message') and comp.message:
+                    # 方式2：从 comp.message 获取，仅在此前未取到引用图片时使用
+                    if hasattr(comp, 'message') and comp.message:
                         for reply_comp in comp.message:
                             if isinstance(reply_comp, Image):
-                                try:
-                                    base64_data = await reply_comp.convert_to_base64()
-                                    images.append(base64_data)
-                                    logger.info("从引用消息(message属性)中获取到图片")
-                                    reply_images_found = True
-                                except Exception as e:
-                                    logger.warning(f"处理引用消息图片失败: {e}")
+                                pending.append((reply_comp, "fallback", index))
+
+        # 并发转换所有图片，结果保持原有顺序
+        labels = {"message": "图片", "reply": "引用消息中的图片", "fallback": "引用消息图片"}
+        results = await asyncio.gather(
+            *(self._image_to_base64(comp, labels[source]) for comp, source, _ in pending)
+        )
+
+        images: list[str] = []
+        reply_images_found = False
+        fallback_index = -1
+        fallback_allowed = False
+        for (_, source, index), base64_data in zip(pending, results):
+            if source == "fallback":
+                # 是否使用某个 Reply 的 message 属性，取决于处理到它之前是否已取到引用图片
+                if index != fallback_index:
+                    fallback_index = index
+                    fallback_allowed = not reply_images_found
+                if not fallback_allowed:
+                    continue
+            if base64_data is None:
+                continue
+            images.append(base64_data)
+            if source == "message":
+                logger.info("从消息中获取到图片")
+            else:
+                reply_images_found = True
+                if source == "reply":
+                    logger.info("从引用消息中获取到图片")
+                else:
+                    logger.info("从引用消息(message属性)中获取到图片")
 
         # 方式3：如果有 reply_id 但没获取到图片，尝试通过 API 获取被引用消息
         if reply_id and not reply_images_found and not images:
@@ -448,8 +600,9 @@ class MyPlugin(Star):
         text_parts: list[str] = []
         
         # 方法1：从 message_obj.message 组件列表中提取
-        if hasattr(event, "message_obj") and event.message_obj and hasattr(event.message_obj, "message"):
-            for comp in event.message_obj.message:
+        message = getattr(getattr(event, "message_obj", None), "message", None)
+        if message:
+            for comp in message:
                 # 处理 Plain 文本组件
                 if isinstance(comp, Plain):
                     try:
@@ -477,161 +630,66 @@ class MyPlugin(Star):
         
         # 移除指令部分（如 "/改图" 或 "改图"），使用 DOTALL 模式处理换行
         # 匹配指令及其后面可能的空白字符（包括换行）
-        pattern = rf'/?{re.escape(command)}[\s]*'
-        full_text = re.sub(pattern, '', full_text, count=1)
+        full_text = _get_command_pattern(command).sub('', full_text, count=1)
         
         # 清理：将多个连续空白字符（空格、制表符）替换为单个空格，但保留换行的语义
-        # 先将换行符替换为特殊标记，清理空格后再换回来（或者直接保留为空格）
-        full_text = re.sub(r'[ \t]+', ' ', full_text)  # 只清理空格和制表符
-        full_text = re.sub(r'\n\s*\n', '\n', full_text)  # 多个换行合并为一个
+        full_text = _SPACES_PATTERN.sub(' ', full_text)  # 只清理空格和制表符
+        full_text = _BLANK_LINES_PATTERN.sub('\n', full_text)  # 多个换行合并为一个
         full_text = full_text.strip()
         
         return full_text
 
-    @filter.command("生图")
-    async def generate_image_command(
+    async def _run_image_command(
         self,
         event: AstrMessageEvent,
-        image_description: str = "",
+        prompt: str,
+        input_images: list[str],
+        command_name: str,
+        success_text: str | None = None,
     ):
-        """纯文本生图指令 `/生图`，专注于根据文字描述生成图片。"""
-        if not self._is_group_allowed(event):
-            return
-
-        if not await self._check_and_consume_rate_limit(event):
-            yield event.plain_result("本群本周期内的插件调用次数已达上限，请稍后再试。")
-            return
-
-        # NAP 文件转发配置
-        nap_server_address = self.nap_server_address
-        nap_server_port = self.nap_server_port
-
-        if not image_description:
-            raw = getattr(event, "message_str", "") or ""
-            parts = raw.strip().split(" ", 1)
-            if len(parts) == 2:
-                image_description = parts[1].strip()
-            else:
-                image_description = ""
-
-        if not image_description:
-            yield event.plain_result(
-                "请提供要生成图像的文字描述，例如：/生图 一只坐在键盘上的橙色猫，赛博朋克风格。"
-            )
-            return
-
-        input_images: list = []
-
-        try:
-            image_url, image_path, error_reason = await self._generate_image_via_provider(
-                image_description,
-                input_images=input_images,
-            )
-
-            if not image_url or not image_path:
-                error_msg = self._get_error_message(error_reason, "图像生成")
-                yield event.chain_result([Plain(error_msg)])
-                return
-
-            if self.nap_server_address and self.nap_server_address != "localhost":
-                image_path = await send_file(image_path, HOST=nap_server_address, PORT=nap_server_port)
-
-            image_component = await self.send_image_with_callback_api(image_path)
-            chain = [image_component]
-            yield event.chain_result(chain)
-
-        except (ConnectionError, TimeoutError) as e:
-            logger.error(f"网络连接错误导致图像生成失败: {e}")
-            error_chain = [Plain(f"网络连接错误，图像生成失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-        except ValueError as e:
-            logger.error(f"参数错误导致图像生成失败: {e}")
-            error_chain = [Plain(f"参数错误，图像生成失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-        except Exception as e:
-            logger.error(f"图像生成过程出现未预期的错误: {e}")
-            error_chain = [Plain(f"图像生成失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-
-    @filter.command("手办化")
-    async def figure_transform(self, event: AstrMessageEvent):
-        """将用户提供的图片转换为手办效果。
-
-        使用方法：发送图片并使用 /手办化 指令
         """
-        if not self._is_group_allowed(event):
-            return
-
-        if not await self._check_and_consume_rate_limit(event):
-            yield event.plain_result("本群本周期内的插件调用次数已达上限，请稍后再试。")
-            return
-
-        input_images = await self._collect_input_images(event)
-
-        if not input_images:
-            yield event.plain_result(
-                "请提供一张图片以进行手办化处理！\n发送图片后使用 /手办化 指令，或者回复包含图片的消息并使用 /手办化 指令。"
-            )
-            return
-
-        logger.info(f"开始手办化处理，使用了 {len(input_images)} 张图片")
-
-        figure_prompt = """Please accurately transform the main subject in this image into a realistic, masterpiece-quality 1/7 scale PVC figure.
-
-Specific Requirements:
-1. **Figure Creation**: Convert the subject into a high-quality PVC figure with obvious three-dimensional depth and the characteristic glossy finish of PVC material
-2. **Packaging Box Design**: Place an exquisite packaging box beside the figure. The front of the box should have a large transparent window displaying the original image, along with brand logos, product name, barcode, and detailed specification panels
-3. **Display Base**: The figure should be placed on a round, transparent plastic base with visible thickness
-4. **Background Setup**: Place a computer monitor in the background, with the screen displaying the ZBrush 3D modeling process of this figure
-5. **Indoor Scene**: Set the entire scene in an indoor environment with appropriate lighting effects
-
-Technical Requirements:
-- Maintain the exact characteristics, expressions, and poses from the original image
-- The figure must have obvious three-dimensional effects and must never appear flat
-- PVC material texture should be clearly visible and realistic
-- Avoid any cartoon outline strokes
-- If the original image is not full-body, complete it as a full-body figure
-- Character proportions should be natural and coordinated (head not too large, legs not too short)
-- For animal figures, reduce fur realism to make it more statue-like rather than the real creature
-- Pay attention to perspective relationships with near objects appearing larger and distant objects smaller
-- No outer outline lines should be present
-
-Please ensure the final result looks like a real commercial figure product that could exist in the market."""
+        各图像指令共用的执行流程：调用生成、按需转发到 NAP、发送结果。
 
+        Args:
+            event: 消息事件
+            prompt: 发送给模型的提示词
+            input_images: 参考图片（base64 字符串列表）
+            command_name: 用于错误消息的名称（如 "手办化处理"）
+            success_text: 成功时附在图片前的文字，None 表示只发送图片
+        """
         try:
             image_url, image_path, error_reason = await self._generate_image_via_provider(
-                figure_prompt,
+                prompt,
                 input_images=input_images,
             )
 
             if not image_url or not image_path:
-                error_msg = self._get_error_message(error_reason, "手办化处理")
+                error_msg = self._get_error_message(error_reason, command_name)
                 yield event.chain_result([Plain(error_msg)])
                 return
 
-            if self.nap_server_address and self.nap_server_address != "localhost":
+            if self._nap_enabled:
                 image_path = await send_file(image_path, HOST=self.nap_server_address, PORT=self.nap_server_port)
 
             image_component = await self.send_image_with_callback_api(image_path)
-            result_chain = [Plain("✨ 手办化处理完成！"), image_component]
+            result_chain = [Plain(success_text), image_component] if success_text else [image_component]
             yield event.chain_result(result_chain)
 
         except (ConnectionError, TimeoutError) as e:
-            logger.error(f"网络连接错误导致手办化处理失败: {e}")
-            error_chain = [Plain(f"网络连接错误，手办化处理失败: {str(e)}")]
+            logger.error(f"网络连接错误导致{command_name}失败: {e}")
+            error_chain = [Plain(f"网络连接错误，{command_name}失败: {str(e)}")]
             yield event.chain_result(error_chain)
         except ValueError as e:
-            logger.error(f"参数错误导致手办化处理失败: {e}")
-            error_chain = [Plain(f"参数错误，手办化处理失败: {str(e)}")]
+            logger.error(f"参数错误导致{command_name}失败: {e}")
+            error_chain = [Plain(f"参数错误，{command_name}失败: {str(e)}")]
             yield event.chain_result(error_chain)
         except Exception as e:
-            logger.error(f"手办化处理过程出现未预期的错误: {e}")
-            error_chain = [Plain(f"手办化处理失败: {str(e)}")]
+            logger.error(f"{command_name}过程出现未预期的错误: {e}")
+            error_chain = [Plain(f"{command_name}失败: {str(e)}")]
             yield event.chain_result(error_chain)
 
-    @filter.command("手办化2")
-    async def figure_transform_v2(self, event: AstrMessageEvent):
-        """手办化 2：顶级收藏级树脂手办风格。"""
+    async def _run_figure_command(self, event: AstrMessageEvent, command: str, prompt: str):
+        """手办化系列指令的共用流程：群过滤、限流、收集图片后执行生成。"""
         if not self._is_group_allowed(event):
             return
 
@@ -643,53 +701,28 @@ Please ensure the final result looks like a real commercial figure product that
 
         if not input_images:
             yield event.plain_result(
-                "请提供一张图片以进行手办化处理！\n发送图片后使用 /手办化2 指令，或者回复包含图片的消息并使用 /手办化2 指令。"
+                f"请提供一张图片以进行手办化处理！\n发送图片后使用 /{command} 指令，或者回复包含图片的消息并使用 /{command} 指令。"
             )
             return
 
-        logger.info(f"开始手办化2处理，使用了 {len(input_images)} 张图片")
+        logger.info(f"开始{command}处理，使用了 {len(input_images)} 张图片")
 
-        figure_prompt = (
-            "将画面中的角色重塑为顶级收藏级树脂手办，全身动态姿势，置于角色主题底座，高精度材质，手工涂装，"
-            "肌肤纹理与服装材质真实分明。戏剧性硬光为主光源，凸显立体感，无过曝；强效补光消除死黑，细节完整可见。"
-            "背景为窗边景深模糊，侧后方隐约可见产品包装盒。博物馆级摄影质感，全身细节无损，面部结构精准。"
-            "禁止：任何2D元素或照搬原图、塑料感、面部模糊、五官错位、细节丢失。"
-        )
-
-        try:
-            image_url, image_path, error_reason = await self._generate_image_via_provider(
-                figure_prompt,
-                input_images=input_images,
-            )
-
-            if not image_url or not image_path:
-                error_msg = self._get_error_message(error_reason, "手办化2处理")
-                yield event.chain_result([Plain(error_msg)])
-                return
-
-            if self.nap_server_address and self.nap_server_address != "localhost":
-                image_path = await send_file(image_path, HOST=self.nap_server_address, PORT=self.nap_server_port)
-
-            image_component = await self.send_image_with_callback_api(image_path)
-            result_chain = [Plain("✨ 手办化2处理完成！"), image_component]
-            yield event.chain_result(result_chain)
-
-        except (ConnectionError, TimeoutError) as e:
-            logger.error(f"网络连接错误导致手办化2处理失败: {e}")
-            error_chain = [Plain(f"网络连接错误，手办化2处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-        except ValueError as e:
-            logger.error(f"参数错误导致手办化2处理失败: {e}")
-            error_chain = [Plain(f"参数错误，手办化2处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-        except Exception as e:
-            logger.error(f"手办化2处理过程出现未预期的错误: {e}")
-            error_chain = [Plain(f"手办化2处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
+        async for result in self._run_image_command(
+            event,
+            prompt,
+            input_images,
+            f"{command}处理",
+            f"✨ {command}处理完成！",
+        ):
+            yield result
 
-    @filter.command("手办化3")
-    async def figure_transform_v3(self, event: AstrMessageEvent):
-        """手办化 3：1/7 比例展示柜商业化手办风格。"""
+    @filter.command("生图")
+    async def generate_image_command(
+        self,
+        event: AstrMessageEvent,
+        image_description: str = "",
+    ):
+        """纯文本生图指令 `/生图`，专注于根据文字描述生成图片。"""
         if not self._is_group_allowed(event):
             return
 
@@ -697,59 +730,43 @@ Please ensure the final result looks like a real commercial figure product that
             yield event.plain_result("本群本周期内的插件调用次数已达上限，请稍后再试。")
             return
 
-        input_images = await self._collect_input_images(event)
+        if not image_description:
+            raw = getattr(event, "message_str", "") or ""
+            parts = raw.strip().split(" ", 1)
+            if len(parts) == 2:
+                image_description = parts[1].strip()
+            else:
+                image_description = ""
 
-        if not input_images:
+        if not image_description:
             yield event.plain_result(
-                "请提供一张图片以进行手办化处理！\n发送图片后使用 /手办化3 指令，或者回复包含图片的消息并使用 /手办化3 指令。"
+                "请提供要生成图像的文字描述，例如：/生图 一只坐在键盘上的橙色猫，赛博朋克风格。"
             )
             return
 
-        logger.info(f"开始手办化3处理，使用了 {len(input_images)} 张图片")
-
-        figure_prompt = (
-            "Create a highly realistic 1/7 scale commercialized figure based on the illustration's adult character, "
-            "ensuring the appearance and content are safe, healthy, and free from any inappropriate elements. "
-            "Render the figure in a detailed, lifelike style and environment, placed on a shelf inside an ultra-realistic "
-            "figure display cabinet, mounted on a circular transparent acrylic base without any text. Maintain highly precise "
-            "details in texture, material, and paintwork to enhance realism. The cabinet scene should feature a natural depth "
-            "of field with a smooth transition between foreground and background for a realistic photographic look. Lighting "
-            "should appear natural and adaptive to the scene, automatically adjusting based on the overall composition instead "
-            "of being locked to a specific direction, simulating the quality and reflection of real commercial photography. "
-            "Other shelves in the cabinet should contain different figures which are slightly blurred due to being out of focus, "
-            "enhancing spatial realism and depth."
-        )
+        async for result in self._run_image_command(event, image_description, [], "图像生成"):
+            yield result
 
-        try:
-            image_url, image_path, error_reason = await self._generate_image_via_provider(
-                figure_prompt,
-                input_images=input_images,
-            )
-
-            if not image_url or not image_path:
-                error_msg = self._get_error_message(error_reason, "手办化3处理")
-                yield event.chain_result([Plain(error_msg)])
-                return
+    @filter.command("手办化")
+    async def figure_transform(self, event: AstrMessageEvent):
+        """将用户提供的图片转换为手办效果。
 
-            if self.nap_server_address and self.nap_server_address != "localhost":
-                image_path = await send_file(image_path, HOST=self.nap_server_address, PORT=self.nap_server_port)
+        使用方法：发送图片并使用 /手办化 指令
+        """
+        async for result in self._run_figure_command(event, "手办化", _FIGURE_PROMPT_V1):
+            yield result
 
-            image_component = await self.send_image_with_callback_api(image_path)
-            result_chain = [Plain("✨ 手办化3处理完成！"), image_component]
-            yield event.chain_result(result_chain)
+    @filter.command("手办化2")
+    async def figure_transform_v2(self, event: AstrMessageEvent):
+        """手办化 2：顶级收藏级树脂手办风格。"""
+        async for result in self._run_figure_command(event, "手办化2", _FIGURE_PROMPT_V2):
+            yield result
 
-        except (ConnectionError, TimeoutError) as e:
-            logger.error(f"网络连接错误导致手办化3处理失败: {e}")
-            error_chain = [Plain(f"网络连接错误，手办化3处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-        except ValueError as e:
-            logger.error(f"参数错误导致手办化3处理失败: {e}")
-            error_chain = [Plain(f"参数错误，手办化3处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-        except Exception as e:
-            logger.error(f"手办化3处理过程出现未预期的错误: {e}")
-            error_chain = [Plain(f"手办化3处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
+    @filter.command("手办化3")
+    async def figure_transform_v3(self, event: AstrMessageEvent):
+        """手办化 3：1/7 比例展示柜商业化手办风格。"""
+        async for result in self._run_figure_command(event, "手办化3", _FIGURE_PROMPT_V3):
+            yield result
 
     @filter.command("改图")
     async def edit_image_command(
@@ -772,11 +789,10 @@ Please ensure the final result looks like a real commercial figure product that
             yield event.plain_result("本群本周期内的插件调用次数已达上限，请稍后再试。")
             return
 
-        use_reference = str(use_reference_images).lower() in {"true", "1", "yes", "y"}
-
-        # NAP 文件转发配置
-        nap_server_address = self.nap_server_address
-        nap_server_port = self.nap_server_port
+        if isinstance(use_reference_images, bool):
+            use_reference = use_reference_images
+        else:
+            use_reference = str(use_reference_images).strip().lower() in _TRUTHY_VALUES
 
         # 从消息中提取文本描述，支持图片在文字前后的情况
         extracted_description = self._extract_text_from_message(event, "改图")
@@ -796,32 +812,10 @@ Please ensure the final result looks like a real commercial figure product that
 
         logger.info(f"改图指令使用了 {len(input_images)} 张图片")
 
-        try:
-            image_url, image_path, error_reason = await self._generate_image_via_provider(
-                edit_description,
-                input_images=input_images,
-            )
-
-            if not image_url or not image_path:
-                error_msg = self._get_error_message(error_reason, "改图")
-                yield event.chain_result([Plain(error_msg)])
-                return
-
-            if self.nap_server_address and self.nap_server_address != "localhost":
-                image_path = await send_file(image_path, HOST=nap_server_address, PORT=nap_server_port)
-
-            image_component = await self.send_image_with_callback_api(image_path)
-            result_chain = [Plain("✨ 改图完成！"), image_component]
-            yield event.chain_result(result_chain)
-
-        except (ConnectionError, TimeoutError) as e:
-            logger.error(f"网络连接错误导致改图失败: {e}")
-            error_chain = [Plain(f"网络连接错误，改图失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-        except Exception as e:
-            logger.error(f"改图过程出现未预期的错误: {e}")
-            error_chain = [Plain(f"改图失败: {str(e)}")]
-            yield event.chain_result(error_chain)
+        async for result in self._run_image_command(
+            event, edit_description, input_images, "改图", "✨ 改图完成！"
+        ):
+            yield result
 
     @filter.command("img帮助")
     async def img_help(self, event: AstrMessageEvent):
@@ -838,3 +832,8 @@ Please ensure the final result looks like a real commercial figure product that
             "/改图 + 图片 —— 基于已有图片进行改图",
         ]
         yield event.plain_result("\n".join(lines))
+
+    async def terminate(self):
+        """插件卸载时释放共享的网络会话。"""
+        await close_vertex_session()
+        await close_upload_session()
@@ -1,7 +1,156 @@
+import asyncio
+import os
+import random
 import aiohttp
+import aiofiles
 from pathlib import Path
 from astrbot.api import logger
 
+# 流式上传时每次读取的块大小
+_CHUNK_SIZE = 64 * 1024
+
+# 不超过该大小的文件一次性读入缓冲区后立即关闭文件，更大的文件流式上传
+_SMALL_FILE_LIMIT = 4 * 1024 * 1024
+
+# 上传遇到临时性错误时的重试次数与初始退避时间（秒）
+_RETRY_ATTEMPTS = 3
+_RETRY_BASE_DELAY = 0.3
+# Retry-After 指定的等待时间上限（秒）
+_RETRY_AFTER_MAX = 10.0
+
+# 上传共用的 ClientSession，复用连接池避免每次上传重新握手
+_session: aiohttp.ClientSession | None = None
+_session_lock = asyncio.Lock()
+
+
+class _RetryableStatusError(Exception):
+    """服务器返回了可重试的状态码（429/5xx）"""
+
+    def __init__(self, status: int, retry_after: float | None = None):
+        super().__init__(f"状态码 {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """解析以秒为单位的 Retry-After 响应头"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+async def _retry(coro_factory, attempts: int = _RETRY_ATTEMPTS, base: float = _RETRY_BASE_DELAY):
+    """
+    对临时性网络错误进行指数退避重试
+
+    只重试收到响应之前的连接错误、超时以及 429/5xx，
+    服务器已返回 200 后的解析错误不会导致重复上传
+
+    Args:
+        coro_factory: 每次调用返回一个新协程的函数
+        attempts (int): 最大尝试次数
+        base (float): 初始退避时间（秒），之后每次翻倍并加入随机抖动
+
+    Returns:
+        协程的返回值；最后一次尝试仍失败时抛出其异常
+    """
+    for attempt in range(attempts):
+        try:
+            return await coro_factory()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError, _RetryableStatusError) as e:
+            if attempt == attempts - 1:
+                raise
+            delay = base * 2 ** attempt + random.random() * 0.1
+            if isinstance(e, _RetryableStatusError) and e.retry_after is not None:
+                delay = max(delay, min(e.retry_after, _RETRY_AFTER_MAX))
+            logger.warning(f"文件上传失败: {e}，{delay:.1f} 秒后进行第 {attempt + 2} 次尝试")
+            await asyncio.sleep(delay)
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """获取（必要时创建）共享的 ClientSession"""
+    global _session
+    if _session is not None and not _session.closed:
+        return _session
+
+    async with _session_lock:
+        if _session is None or _session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=64,
+                limit_per_host=32,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            _session = aiohttp.ClientSession(connector=connector)
+        return _session
+
+
+async def _stream_file(file_path: str):
+    """按块读取文件，读完后立即关闭文件句柄"""
+    async with aiofiles.open(file_path, "rb") as f:
+        while chunk := await f.read(_CHUNK_SIZE):
+            yield chunk
+
+
+async def close_session():
+    """关闭共享的 ClientSession，在插件卸载时调用"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _upload_once(session: aiohttp.ClientSession, url: str, file_path: str) -> str:
+    """
+    上传一次文件
+
+    Returns:
+        str: 远程文件路径，服务器返回不可重试的错误时返回原路径
+
+    Raises:
+        _RetryableStatusError: 服务器返回 429 或 5xx
+    """
+    file_size = os.path.getsize(file_path)
+
+    if file_size <= _SMALL_FILE_LIMIT:
+        # 小文件先整体读入内存，发送前即关闭文件句柄
+        async with aiofiles.open(file_path, "rb") as f:
+            file_body = await f.read()
+    else:
+        file_body = _stream_file(file_path)
+
+    data = aiohttp.FormData()
+    data.add_field(
+        "file",
+        file_body,
+        filename=Path(file_path).name,
+        content_type="application/octet-stream",
+    )
+
+    async with session.post(url, data=data) as response:
+        if response.status == 200:
+            # 服务器已接收文件，响应无法解析时不再重试，直接使用本地路径
+            try:
+                result = await response.json()
+                remote_path = result.get("path", file_path)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, AttributeError) as e:
+                logger.warning(f"解析上传响应失败: {e}，使用本地路径")
+                return file_path
+            logger.info(f"文件已上传到远程服务器: {remote_path}")
+            return remote_path
+        if response.status == 429 or response.status >= 500:
+            raise _RetryableStatusError(
+                response.status,
+                _parse_retry_after(response.headers.get("Retry-After")),
+            )
+        logger.warning(
+            f"文件上传失败，状态码: {response.status}，使用本地路径"
+        )
+        return file_path
+
 
 async def send_file(file_path: str, HOST: str = "localhost", PORT: int = 3658) -> str:
     """
@@ -18,27 +167,12 @@ async def send_file(file_path: str, HOST: str = "localhost", PORT: int = 3658) -
     try:
         url = f"http://{HOST}:{PORT}/upload"
 
-        async with aiohttp.ClientSession() as session:
-            with open(file_path, "rb") as f:
-                data = aiohttp.FormData()
-                data.add_field(
-                    "file",
-                    f,
-                    filename=Path(file_path).name,
-                    content_type="application/octet-stream",
-                )
-
-                async with session.post(url, data=data) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        remote_path = result.get("path", file_path)
-                        logger.info(f"文件已上传到远程服务器: {remote_path}")
-                        return remote_path
-                    else:
-                        logger.warning(
-                            f"文件上传失败，状态码: {response.status}，使用本地路径"
-                        )
-                        return file_path
+        session = await _get_session()
+        return await _retry(lambda: _upload_once(session, url, file_path))
+
+    except _RetryableStatusError as e:
+        logger.warning(f"文件上传失败，状态码: {e.status}，使用本地路径")
+        return file_path
 
     except FileNotFoundError:
         logger.error(f"文件不存在: {file_path}")
@@ -1,108 +1,210 @@
 import aiohttp
 import asyncio
-import aiofiles
 import base64
+import functools
 import json
-import uuid
+import os
+import random
+import time
 import re
-from datetime import datetime, timedelta
 from pathlib import Path
 from astrbot.api import logger
 
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库 json
+    orjson = None
+
+
+def _json_dumps(obj) -> bytes:
+    """将对象序列化为 UTF-8 编码的 JSON 字节"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 
 class ImageGeneratorState:
-    """图像生成器状态管理类，用于处理并发安全"""
+    """
+    图像生成器状态管理类
+
+    所有方法都不包含 await，在单个事件循环内执行时天然原子，因此无需加锁；
+    并发下偶尔多轮换一次密钥是无害的。
+    """
 
     def __init__(self):
-        self._lock = asyncio.Lock()
         self.api_key_index = 0
-        self.last_saved_image = {"url": None, "path": None}
+        self.last_saved_image = (None, None)
 
-    async def get_current_api_key(self, api_keys):
+    def get_current_api_key(self, api_keys):
         """获取当前使用的API密钥"""
-        async with self._lock:
-            if api_keys and isinstance(api_keys, list) and len(api_keys) > 0:
-                return api_keys[self.api_key_index % len(api_keys)]
-            return None
+        if api_keys and isinstance(api_keys, list):
+            return api_keys[self.api_key_index % len(api_keys)]
+        return None
 
-    async def rotate_to_next_api_key(self, api_keys):
+    def rotate_to_next_api_key(self, api_keys):
         """轮换到下一个API密钥"""
-        async with self._lock:
-            if api_keys and isinstance(api_keys, list) and len(api_keys) > 1:
-                self.api_key_index = (self.api_key_index + 1) % len(api_keys)
-                logger.info(f"已轮换到下一个API密钥，当前索引: {self.api_key_index}")
+        if api_keys and isinstance(api_keys, list) and len(api_keys) > 1:
+            self.api_key_index = (self.api_key_index + 1) % len(api_keys)
+            logger.info(f"已轮换到下一个API密钥，当前索引: {self.api_key_index}")
 
-    async def update_saved_image(self, url, path):
+    def update_saved_image(self, url, path):
         """更新保存的图像信息"""
-        async with self._lock:
-            self.last_saved_image = {"url": url, "path": path}
+        self.last_saved_image = (url, path)
 
-    async def get_saved_image_info(self):
+    def get_saved_image_info(self):
         """获取最后保存的图像信息"""
-        async with self._lock:
-            return self.last_saved_image["url"], self.last_saved_image["path"]
+        return self.last_saved_image
 
 
 # 全局状态管理实例
 _state = ImageGeneratorState()
 
-# 响应文本中图片信息的匹配模式
-_DATA_URL_PATTERN = re.compile(
-    r"(data:image/[a-zA-Z0-9.+-]+;base64,[A-Za-z0-9+/=]+)"
+# 响应文本中图片信息的匹配模式（data URL 与 HTTP URL 合并为一次扫描）
+# data URL 只匹配头部，base64 数据由 _BASE64_RUN_PATTERN 从头部结尾处定位，避免捕获组复制大段数据
+_IMAGE_REF_PATTERN = re.compile(
+    r"(?P<data>data:image/(?P<format>[a-zA-Z0-9.+-]+);base64,)"
+    r"|(?P<url>https?://[^\s)]+)"
 )
-_HTTP_URL_PATTERN = re.compile(r"(https?://[^\s)]+)")
+_BASE64_RUN_PATTERN = re.compile(r"[A-Za-z0-9+/=]*")
+
+# 下载图像时每次写入的块大小
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 图像生成请求的固定参数
+_GENERATION_CONFIG = {
+    "temperature": 1.0,
+    "topP": 0.95,
+    "maxOutputTokens": 8192,
+}
+
+# 需要退避等待后再重试的失败类型；其余失败（如密钥无效）轮换密钥后立即重试
+_BACKOFF_FAILURES = frozenset({"429", "5xx", "timeout", "network"})
+
+# 需要定期清理的图像文件名
+_CLEANUP_FILENAME_PATTERN = re.compile(r"(?:vertex|gemini)_image_.*\.(?:png|jpe?g)\Z")
+
+# 过期图像清理的最小间隔（秒）与上次清理时间（单调时钟）
+_CLEANUP_INTERVAL = 60.0
+_last_cleanup = float("-inf")
+
+# Vertex AI 请求共用的 ClientSession，跨调用复用连接池、TLS 会话与 DNS 缓存
+_session: aiohttp.ClientSession | None = None
+_session_lock = asyncio.Lock()
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """获取（必要时创建）共享的 ClientSession"""
+    global _session
+    if _session is not None and not _session.closed:
+        return _session
+
+    async with _session_lock:
+        if _session is None or _session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=32,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+            _session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=120),
+            )
+        return _session
+
+
+async def close_session():
+    """关闭共享的 ClientSession，在插件卸载时调用"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+@functools.lru_cache(maxsize=8)
+def _get_images_dir(data_dir: Path) -> Path:
+    """获取图像目录，每个 data_dir 只在首次使用时创建一次"""
+    images_dir = data_dir / "images"
+    images_dir.mkdir(parents=True, exist_ok=True)
+    return images_dir
+
+
+def _list_cleanup_candidates(images_dir: Path) -> list[str]:
+    """列出图像目录中文件名符合清理规则的文件路径"""
+    with os.scandir(images_dir) as entries:
+        return [
+            entry.path
+            for entry in entries
+            if _CLEANUP_FILENAME_PATTERN.match(entry.name) and entry.is_file(follow_symlinks=False)
+        ]
+
+
+def _remove_if_expired(path: str, cutoff_ts: float):
+    """文件修改时间早于 cutoff_ts 时删除该文件"""
+    try:
+        if os.stat(path).st_mtime < cutoff_ts:
+            os.unlink(path)
+            logger.debug(f"已清理过期图像: {os.path.basename(path)}")
+    except OSError as e:
+        logger.warning(f"清理文件 {path} 时出错: {e}")
 
 
 async def cleanup_old_images(data_dir=None):
     """
-    清理超过15分钟的图像文件
+    清理超过15分钟的图像文件，两次清理之间至少间隔 _CLEANUP_INTERVAL 秒
 
     Args:
         data_dir (Path): 数据目录路径，必须提供
     """
+    global _last_cleanup
+
     if data_dir is None:
         logger.warning("cleanup_old_images: 未提供 data_dir，跳过清理")
         return
 
+    now = time.monotonic()
+    if now - _last_cleanup < _CLEANUP_INTERVAL:
+        return
+    _last_cleanup = now
+
     try:
-        images_dir = data_dir / "images"
-
-        if not images_dir.exists():
-            return
-
-        current_time = datetime.now()
-        cutoff_time = current_time - timedelta(minutes=15)
-
-        # 查找images目录下的所有图像文件
-        image_patterns = [
-            "vertex_image_*.png",
-            "vertex_image_*.jpg",
-            "vertex_image_*.jpeg",
-            "gemini_image_*.png",
-            "gemini_image_*.jpg",
-            "gemini_image_*.jpeg",
-        ]
+        images_dir = _get_images_dir(data_dir)
+        cutoff_ts = time.time() - 15 * 60
 
-        for pattern in image_patterns:
-            for file_path in images_dir.glob(pattern):
-                try:
-                    file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-                    if file_mtime < cutoff_time:
-                        file_path.unlink()
-                        logger.debug(f"已清理过期图像: {file_path.name}")
-                except OSError as e:
-                    logger.warning(f"清理文件 {file_path} 时出错: {e}")
+        # 单次遍历目录筛选文件名，再并发地在线程中检查并删除过期文件
+        candidates = await asyncio.to_thread(_list_cleanup_candidates, images_dir)
+        await asyncio.gather(
+            *(asyncio.to_thread(_remove_if_expired, path, cutoff_ts) for path in candidates)
+        )
 
     except Exception as e:
         logger.error(f"清理过期图像时发生错误: {e}")
 
 
-async def save_base64_image(base64_string, image_format="png", data_dir=None):
+def _decode_and_write(base64_string: str, path: Path):
+    """解码 base64 并写入文件，供 asyncio.to_thread 在一次线程切换内完成"""
+    path.write_bytes(base64.b64decode(base64_string))
+
+
+async def _stream_to_file(content: aiohttp.StreamReader, path: Path):
+    """将 HTTP 响应体按块写入文件，文件操作在线程中执行"""
+    f = await asyncio.to_thread(open, path, "wb")
+    try:
+        async for chunk in content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+            await asyncio.to_thread(f.write, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def _save_image(write, image_format, data_dir):
     """
-    将base64编码的图像保存到文件
+    生成文件名并调用 write(file_path) 保存图像
 
     Args:
-        base64_string (str): base64编码的图像数据
+        write: 接收文件路径并写入图像内容的协程函数
         image_format (str): 图像格式
         data_dir (Path): 数据目录路径，必须提供
 
@@ -110,53 +212,122 @@ async def save_base64_image(base64_string, image_format="png", data_dir=None):
         tuple: (image_url, image_path)
     """
     if data_dir is None:
-        logger.error("save_base64_image: 未提供 data_dir，无法保存图像")
+        logger.error("保存图像: 未提供 data_dir，无法保存图像")
         return None, None
 
+    file_path = None
     try:
-        images_dir = data_dir / "images"
-        images_dir.mkdir(parents=True, exist_ok=True)
-
         # 清理过期图像
         await cleanup_old_images(data_dir)
 
-        # 生成唯一文件名
-        unique_id = uuid.uuid4().hex[:8]
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"vertex_image_{timestamp}_{unique_id}.{image_format}"
-        file_path = images_dir / filename
+        # 生成唯一文件名：毫秒时间戳 + 8 位随机十六进制
+        filename = f"vertex_image_{int(time.time() * 1000):013d}_{os.urandom(4).hex()}.{image_format}"
 
-        # 解码并保存图像
-        image_data = base64.b64decode(base64_string)
-        async with aiofiles.open(file_path, "wb") as f:
-            await f.write(image_data)
+        for attempt in range(2):
+            file_path = _get_images_dir(data_dir) / filename
+            try:
+                await write(file_path)
+                break
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                # 图像目录在运行期间被删除，清除缓存后重新创建并重试一次
+                logger.warning("图像目录不存在，重新创建后重试")
+                _get_images_dir.cache_clear()
 
         image_url = f"file://{file_path}"
         image_path = str(file_path)
 
-        await _state.update_saved_image(image_url, image_path)
+        _state.update_saved_image(image_url, image_path)
 
         logger.info(f"图像已保存: {file_path}")
         return image_url, image_path
 
     except Exception as e:
         logger.error(f"保存图像时发生错误: {e}")
+        # 删除写入失败留下的不完整文件
+        if file_path is not None:
+            try:
+                file_path.unlink(missing_ok=True)
+            except OSError:
+                pass
         return None, None
 
 
+async def save_base64_image(base64_string, image_format="png", data_dir=None):
+    """
+    将base64编码的图像保存到文件
+
+    Args:
+        base64_string (str): base64编码的图像数据
+        image_format (str): 图像格式
+        data_dir (Path): 数据目录路径，必须提供
+
+    Returns:
+        tuple: (image_url, image_path)
+    """
+    # 在线程中解码并写入，避免大图阻塞事件循环
+    return await _save_image(
+        lambda path: asyncio.to_thread(_decode_and_write, base64_string, path),
+        image_format,
+        data_dir,
+    )
+
+
+async def _save_image_stream(content: aiohttp.StreamReader, image_format="png", data_dir=None):
+    """
+    将 HTTP 响应体直接流式保存到文件
+
+    Args:
+        content (aiohttp.StreamReader): 响应体
+        image_format (str): 图像格式
+        data_dir (Path): 数据目录路径，必须提供
+
+    Returns:
+        tuple: (image_url, image_path)
+    """
+    return await _save_image(
+        lambda path: _stream_to_file(content, path),
+        image_format,
+        data_dir,
+    )
+
+
 async def get_next_api_key(api_keys):
     """获取当前API密钥"""
-    return await _state.get_current_api_key(api_keys)
+    return _state.get_current_api_key(api_keys)
 
 
 async def rotate_to_next_api_key(api_keys):
     """轮换到下一个API密钥"""
-    await _state.rotate_to_next_api_key(api_keys)
+    _state.rotate_to_next_api_key(api_keys)
 
 
 async def get_saved_image_info():
     """获取最后保存的图像信息"""
-    return await _state.get_saved_image_info()
+    return _state.get_saved_image_info()
+
+
+class _LazyBodyPreview:
+    """响应体预览，仅在日志真正输出时才截取并解码"""
+
+    __slots__ = ("body", "limit")
+
+    def __init__(self, body: bytes, limit: int = 500):
+        self.body = body
+        self.limit = limit
+
+    def __str__(self):
+        return self.body[:self.limit].decode("utf-8", "replace")
+
+
+def _strip_data_url_prefix(img_base64: str) -> str:
+    """去掉 data URL 前缀，返回纯 base64 部分"""
+    if img_base64.startswith("data:"):
+        comma = img_base64.find(",", 5)
+        if comma != -1:
+            return img_base64[comma + 1:]
+    return img_base64
 
 
 async def generate_image_vertex(
@@ -201,33 +372,16 @@ async def generate_image_vertex(
     # 构建 Vertex AI API URL
     base_url = "https://aiplatform.googleapis.com/v1/publishers/google/models"
     
-    # 构建请求内容
-    parts = []
-    
-    # 添加文本提示
-    # 添加明确的图像生成指令
+    # 构建请求内容：明确的图像生成指令 + 输入图像（如果有）
     full_prompt = f"Generate an image based on the following description. Output only the image, no text explanation needed.\n\n{prompt}"
-    parts.append({"text": full_prompt})
-    
-    # 添加输入图像（如果有）
+    parts = [{"text": full_prompt}]
+
     if input_images:
-        for img_base64 in input_images:
-            if img_base64:
-                # 清理 base64 字符串
-                clean_base64 = img_base64
-                if clean_base64.startswith("data:"):
-                    # 提取纯 base64 部分
-                    try:
-                        clean_base64 = clean_base64.split(",", 1)[1]
-                    except IndexError:
-                        pass
-                
-                parts.append({
-                    "inlineData": {
-                        "mimeType": "image/png",
-                        "data": clean_base64
-                    }
-                })
+        parts.extend(
+            {"inlineData": {"mimeType": "image/png", "data": _strip_data_url_prefix(img_base64)}}
+            for img_base64 in input_images
+            if img_base64
+        )
         logger.info(f"已添加 {len(input_images)} 张参考图片")
 
     payload = {
@@ -237,172 +391,190 @@ async def generate_image_vertex(
                 "parts": parts
             }
         ],
-        "generationConfig": {
-            "temperature": 1.0,
-            "topP": 0.95,
-            "maxOutputTokens": 8192
-        }
+        "generationConfig": _GENERATION_CONFIG,
     }
 
-    timeout = aiohttp.ClientTimeout(total=120)
-
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        for retry_attempt in range(max_retry_attempts):
-            try:
-                current_key = await get_next_api_key(api_keys)
-                if not current_key:
-                    logger.error("无可用的 API 密钥")
-                    return None, None, "NO_API_KEY"
-
-                url = f"{base_url}/{model}:generateContent?key={current_key}"
+    # 请求地址、公共请求头与请求体只需构建一次，重试时复用
+    endpoint = f"{base_url}/{model}:generateContent"
+    base_headers = {"Content-Type": "application/json"}
+    request_body = _json_dumps(payload)
+
+    session = await _get_session()
+
+    # 上一次失败的类型，用于决定重试前是否等待
+    last_failure = None
+
+    for retry_attempt in range(max_retry_attempts):
+        try:
+            current_key = _state.get_current_api_key(api_keys)
+            if not current_key:
+                logger.error("无可用的 API 密钥")
+                return None, None, "NO_API_KEY"
+
+            # API 密钥通过请求头传递，避免出现在 URL 中
+            headers = {**base_headers, "x-goog-api-key": current_key}
+
+            if retry_attempt > 0 and last_failure in _BACKOFF_FAILURES:
+                # 加入随机抖动，避免大量请求同时重试
+                delay = min(2 ** retry_attempt, 10) * (0.5 + random.random())
+                logger.info(
+                    f"第 {retry_attempt + 1} 次重试，等待 {delay:.1f} 秒..."
+                )
+                await asyncio.sleep(delay)
+
+            async with session.post(endpoint, data=request_body, headers=headers) as response:
+                # 直接读取字节，省去整段响应的 UTF-8 解码
+                response_body = await response.read()
                 
-                headers = {
-                    "Content-Type": "application/json"
-                }
-
-                if retry_attempt > 0:
-                    delay = min(2 ** retry_attempt, 10)
-                    logger.info(
-                        f"第 {retry_attempt + 1} 次重试，等待 {delay} 秒..."
-                    )
-                    await asyncio.sleep(delay)
-
-                async with session.post(url, json=payload, headers=headers) as response:
-                    response_text = await response.text()
-                    
-                    if retry_attempt == 0:
-                        logger.debug(f"Vertex AI API 响应状态: {response.status}")
+                if retry_attempt == 0:
+                    logger.debug(f"Vertex AI API 响应状态: {response.status}")
 
-                    if response.status == 200:
-                        try:
-                            data = json.loads(response_text)
-                        except Exception as e:
-                            logger.error(f"解析响应 JSON 失败: {e}")
-                            await rotate_to_next_api_key(api_keys)
-                            continue
+                if response.status == 200:
+                    try:
+                        data = _json_loads(response_body)
+                    except Exception as e:
+                        logger.error(f"解析响应 JSON 失败: {e}")
+                        last_failure = "parse"
+                        _state.rotate_to_next_api_key(api_keys)
+                        continue
+
+                    # 解析响应，查找生成的图像
+                    image_url = None
+                    image_path = None
+                    image_format = "png"
+                    base64_string = None
+
+                    if "candidates" in data and data["candidates"]:
+                        candidate = data["candidates"][0]
+                        content = candidate.get("content", {})
+                        parts = content.get("parts", [])
+
+                        # 绝大多数响应直接在 inlineData 中返回图像，优先查找
+                        inline_data = next(
+                            (
+                                part["inlineData"]
+                                for part in parts
+                                if "inlineData" in part and part["inlineData"].get("data")
+                            ),
+                            None,
+                        )
 
-                        # 解析响应，查找生成的图像
-                        image_url = None
-                        image_path = None
-                        image_format = "png"
-                        base64_string = None
+                        if inline_data is not None:
+                            mime_type = inline_data.get("mimeType", "image/png")
+                            base64_string = inline_data["data"]
 
-                        if "candidates" in data and data["candidates"]:
-                            candidate = data["candidates"][0]
-                            content = candidate.get("content", {})
-                            parts = content.get("parts", [])
+                            # 从 MIME 类型提取格式
+                            if "/" in mime_type:
+                                image_format = mime_type.split("/")[1].split(";")[0]
 
+                            logger.info(f"从响应中获取到图像数据，格式: {image_format}")
+                        else:
+                            # 检查文本中是否包含 base64 图像
                             for part in parts:
-                                # 检查 inlineData（图像数据）
-                                if "inlineData" in part:
-                                    inline_data = part["inlineData"]
-                                    mime_type = inline_data.get("mimeType", "image/png")
-                                    base64_string = inline_data.get("data")
-                                    
-                                    # 从 MIME 类型提取格式
-                                    if "/" in mime_type:
-                                        image_format = mime_type.split("/")[1].split(";")[0]
-                                    
-                                    if base64_string:
-                                        logger.info(f"从响应中获取到图像数据，格式: {image_format}")
-                                        break
-                                
-                                # 检查文本中是否包含 base64 图像
-                                elif "text" in part:
-                                    text = part["text"]
-                                    # 尝试匹配 data URL
-                                    data_match = _DATA_URL_PATTERN.search(text)
-                                    if data_match:
-                                        candidate_url = data_match.group(1)
-                                        try:
-                                            header, base64_part = candidate_url.split(",", 1)
-                                            image_format = header.split("/")[1].split(";")[0]
-                                            base64_string = base64_part
+                                if "text" not in part:
+                                    continue
+                                text = part["text"]
+                                part_url = None
+                                for match in _IMAGE_REF_PATTERN.finditer(text):
+                                    # 优先使用 data URL
+                                    if match.lastgroup == "data":
+                                        payload_end = _BASE64_RUN_PATTERN.match(text, match.end()).end()
+                                        if payload_end > match.end():
+                                            image_format = match.group("format")
+                                            base64_string = text[match.end():payload_end]
                                             logger.info("从文本响应中提取到 base64 图像")
                                             break
-                                        except Exception as e:
-                                            logger.warning(f"解析文本中的 data URL 失败: {e}")
-                                    
-                                    # 尝试匹配 HTTP URL
-                                    url_match = _HTTP_URL_PATTERN.search(text)
-                                    if url_match:
-                                        image_url = url_match.group(1)
-                                        logger.info(f"从文本响应中提取到图像 URL: {image_url}")
-
-                        # 如果获取到 base64 图像数据，保存到文件
-                        if base64_string:
-                            image_url, image_path = await save_base64_image(
-                                base64_string, image_format, data_dir
-                            )
-                            if image_url and image_path:
-                                return image_url, image_path, None
-
-                        # 如果获取到 URL，尝试下载图像
-                        if image_url and image_url.startswith("http"):
-                            try:
-                                async with session.get(image_url) as img_response:
-                                    if img_response.status == 200:
-                                        # 从 Content-Type 获取正确的图片格式
-                                        content_type = img_response.headers.get("Content-Type", "image/png")
-                                        if "/" in content_type:
-                                            image_format = content_type.split("/")[1].split(";")[0]
-                                        img_data = await img_response.read()
-                                        base64_string = base64.b64encode(img_data).decode("utf-8")
-                                        image_url, image_path = await save_base64_image(
-                                            base64_string, image_format, data_dir
-                                        )
-                                        if image_url and image_path:
-                                            return image_url, image_path, None
-                            except Exception as e:
-                                logger.warning(f"下载图像失败: {e}")
-
-                        # 检查是否有安全过滤导致的阻止
-                        if "promptFeedback" in data:
-                            feedback = data["promptFeedback"]
-                            if "blockReason" in feedback:
-                                logger.warning(f"请求被安全过滤阻止: {feedback['blockReason']}")
-                                return None, None, "SAFETY_BLOCKED"
-
-                        # 检查 finishReason
-                        if "candidates" in data and data["candidates"]:
-                            finish_reason = data["candidates"][0].get("finishReason", "")
-                            if finish_reason in ["IMAGE_SAFETY", "IMAGE_PROHIBITED_CONTENT", "SAFETY"]:
-                                logger.warning(f"图像生成被安全策略阻止: {finish_reason}")
-                                return None, None, "SAFETY_BLOCKED"
-
-                        logger.warning(f"响应中未找到图像数据，第 {retry_attempt + 1} 次尝试")
-                        await rotate_to_next_api_key(api_keys)
-
-                    elif response.status == 429:
-                        logger.warning("API 请求频率限制，尝试轮换密钥")
-                        await rotate_to_next_api_key(api_keys)
-
-                    elif response.status == 400:
-                        logger.error(f"请求参数错误: {response_text[:500]}")
-                        # 400 错误通常是请求格式问题，不需要轮换密钥
-                        return None, None, "API_ERROR"
-
-                    elif response.status == 401 or response.status == 403:
-                        logger.error(f"API 认证失败 (状态码 {response.status})，尝试轮换密钥")
-                        await rotate_to_next_api_key(api_keys)
-
-                    else:
-                        logger.warning(
-                            f"API 请求失败，状态码: {response.status}，响应: {response_text[:500]}"
-                        )
-                        await rotate_to_next_api_key(api_keys)
+                                    elif part_url is None:
+                                        part_url = match.group("url")
 
-            except asyncio.TimeoutError:
-                logger.warning(f"API 请求超时，第 {retry_attempt + 1} 次尝试")
-                await rotate_to_next_api_key(api_keys)
+                                if base64_string:
+                                    break
 
-            except aiohttp.ClientError as e:
-                logger.warning(f"网络请求错误: {e}，第 {retry_attempt + 1} 次尝试")
-                await rotate_to_next_api_key(api_keys)
+                                if part_url:
+                                    image_url = part_url
+                                    logger.info(f"从文本响应中提取到图像 URL: {image_url}")
 
-            except Exception as e:
-                logger.error(f"未预期的错误: {e}")
-                await rotate_to_next_api_key(api_keys)
+                    # 如果获取到 base64 图像数据，保存到文件
+                    if base64_string:
+                        image_url, image_path = await save_base64_image(
+                            base64_string, image_format, data_dir
+                        )
+                        if image_url and image_path:
+                            return image_url, image_path, None
+
+                    # 如果获取到 URL，尝试下载图像
+                    if image_url and image_url.startswith("http"):
+                        try:
+                            async with session.get(image_url) as img_response:
+                                if img_response.status == 200:
+                                    # 从 Content-Type 获取正确的图片格式
+                                    content_type = img_response.headers.get("Content-Type", "image/png")
+                                    if "/" in content_type:
+                                        image_format = content_type.split("/")[1].split(";")[0]
+                                    image_url, image_path = await _save_image_stream(
+                                        img_response.content, image_format, data_dir
+                                    )
+                                    if image_url and image_path:
+                                        return image_url, image_path, None
+                        except Exception as e:
+                            logger.warning(f"下载图像失败: {e}")
+
+                    # 检查是否有安全过滤导致的阻止
+                    if "promptFeedback" in data:
+                        feedback = data["promptFeedback"]
+                        if "blockReason" in feedback:
+                            logger.warning(f"请求被安全过滤阻止: {feedback['blockReason']}")
+                            return None, None, "SAFETY_BLOCKED"
+
+                    # 检查 finishReason
+                    if "candidates" in data and data["candidates"]:
+                        finish_reason = data["candidates"][0].get("finishReason", "")
+                        if finish_reason in ["IMAGE_SAFETY", "IMAGE_PROHIBITED_CONTENT", "SAFETY"]:
+                            logger.warning(f"图像生成被安全策略阻止: {finish_reason}")
+                            return None, None, "SAFETY_BLOCKED"
+
+                    logger.warning(f"响应中未找到图像数据，第 {retry_attempt + 1} 次尝试")
+                    last_failure = "no_image"
+                    _state.rotate_to_next_api_key(api_keys)
+
+                elif response.status == 429:
+                    logger.warning("API 请求频率限制，尝试轮换密钥")
+                    last_failure = "429"
+                    _state.rotate_to_next_api_key(api_keys)
+
+                elif response.status == 400:
+                    logger.error("请求参数错误: %s", _LazyBodyPreview(response_body))
+                    # 400 错误通常是请求格式问题，不需要轮换密钥
+                    return None, None, "API_ERROR"
+
+                elif response.status == 401 or response.status == 403:
+                    logger.error(f"API 认证失败 (状态码 {response.status})，尝试轮换密钥")
+                    last_failure = "auth"
+                    _state.rotate_to_next_api_key(api_keys)
+
+                else:
+                    logger.warning(
+                        "API 请求失败，状态码: %s，响应: %s",
+                        response.status,
+                        _LazyBodyPreview(response_body),
+                    )
+                    last_failure = "5xx" if response.status >= 500 else "status"
+                    _state.rotate_to_next_api_key(api_keys)
+
+        except asyncio.TimeoutError:
+            logger.warning(f"API 请求超时，第 {retry_attempt + 1} 次尝试")
+            last_failure = "timeout"
+            _state.rotate_to_next_api_key(api_keys)
+
+        except aiohttp.ClientError as e:
+            logger.warning(f"网络请求错误: {e}，第 {retry_attempt + 1} 次尝试")
+            last_failure = "network"
+            _state.rotate_to_next_api_key(api_keys)
+
+        except Exception as e:
+            logger.error(f"未预期的错误: {e}")
+            last_failure = "error"
+            _state.rotate_to_next_api_key(api_keys)
 
     logger.error("Vertex AI API 调用失败，已达到最大重试次数")
     return None, None, "API_ERROR"